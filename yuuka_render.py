@@ -1,17 +1,35 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-import google.generativeai as genai
+from google import genai
+from google.genai import types
 import os
 from dotenv import load_dotenv
 import asyncio
 import io
+import math
+import time
 from PIL import Image
-import glob
 import json
+import re
+import functools
 import websockets
+from websockets.protocol import State
 from typing import Union
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+
+try:
+    import orjson  # 설치되어 있으면 더 빠른 JSON 직렬화/파싱을 사용
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError는 json.JSONDecodeError의 하위 클래스이므로 기존 예외 처리가 그대로 동작함
+json_loads = orjson.loads if orjson is not None else json.loads
+
+try:
+    import uvloop  # libuv 기반 이벤트 루프 (Windows 등 미지원 환경에서는 기본 asyncio 루프 사용)
+except ImportError:
+    uvloop = None
 
 # .env 파일이 저장될 영구 디스크 경로 (Render 환경 변수에서 가져옴)
 # 로컬 테스트를 위해 기본값으로 '.env'를 사용합니다.
@@ -35,10 +53,35 @@ if not all([DISCORD_BOT_TOKEN, GEMINI_API_KEY, WEB_BASE_URL]):
     if not os.path.exists(".env"):
         exit()
 
+# .env 파일의 KEY=VALUE 내용을 메모리에 보관 (update_env_variable 첫 호출 시 채워짐)
+_env_cache = None
+
+def read_env_file():
+    """
+    지정된 경로의 .env 파일을 읽어 {키: 값} 딕셔너리로 반환하는 함수
+    """
+    values = {}
+    if os.path.exists(ENV_FILE_PATH):
+        with open(ENV_FILE_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                name, sep, val = line.strip().partition("=")
+                if sep and not name.startswith("#"):
+                    values[name] = val
+    return values
+
 def update_env_variable(key: str, value: str):
     """
     지정된 경로의 .env 파일(.env)의 특정 변수를 업데이트하는 함수
     """
+    global _env_cache
+    if _env_cache is None:
+        _env_cache = read_env_file()
+
+    # 값이 바뀌지 않았다면 파일을 다시 쓰지 않음
+    if _env_cache.get(key) == value:
+        os.environ[key] = value
+        return
+
     lines = []
     found = False
     
@@ -50,7 +93,9 @@ def update_env_variable(key: str, value: str):
         with open(ENV_FILE_PATH, "r", encoding="utf-8") as f:
             lines = f.readlines()
 
-    with open(ENV_FILE_PATH, "w", encoding="utf-8") as f:
+    # 임시 파일에 먼저 쓴 뒤 교체하여, 쓰기 도중 종료되어도 .env 파일이 깨지지 않도록 함
+    tmp_path = f"{ENV_FILE_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         for line in lines:
             if line.strip().startswith(f"{key}="):
                 f.write(f"{key}={value}\n")
@@ -59,7 +104,9 @@ def update_env_variable(key: str, value: str):
                 f.write(line)
         if not found:
             f.write(f"{key}={value}\n")
+    os.replace(tmp_path, ENV_FILE_PATH)
 
+    _env_cache[key] = value
     os.environ[key] = value
     print(f"'{ENV_FILE_PATH}' 파일에 {key}={value} 로 업데이트 완료 및 환경 변수 적용")
 
@@ -74,13 +121,43 @@ def load_persona_prompt(file_path="persona.txt"):
 GEM_PROMPT = load_persona_prompt()
 knowledge_cache = {}
 KNOWLEDGE_BASE_DIR = "knowledge_base"
-processing_lock = asyncio.Lock()
-chat_sessions = {}
+KNOWLEDGE_TEXT_EXTENSIONS = {"txt", "md"}
+KNOWLEDGE_IMAGE_EXTENSIONS = {"png", "jpg", "jpeg", "webp"}
+# Gemini로 보내는 이미지의 최대 가로/세로 크기(px)
+IMAGE_MAX_SIDE = 1024
+# 지식 베이스 이미지들을 하나로 합칠 때 격자 한 칸의 크기(px)와 합성 이미지의 최대 크기(px)
+KNOWLEDGE_TILE_SIDE = 512
+KNOWLEDGE_COMPOSITE_MAX_SIDE = 2048
+# 메시지마다 다시 만들지 않도록 load_knowledge_base에서 미리 구성해 두는 프롬프트 구성 요소
+KNOWLEDGE_TEXT = ""
+KNOWLEDGE_COMPOSITE = None
+# load_knowledge_base가 실행될 때마다 증가 (요청 도중 지식이 갱신되었는지 확인용)
+KNOWLEDGE_GENERATION = 0
+# 서버별 채팅 세션을 보관할 최대 서버 수 (가장 오래 사용하지 않은 서버부터 정리)
+MAX_CACHED_GUILDS = 256
+chat_sessions = OrderedDict()
+# 현재 채팅 세션에 지식 베이스를 이미 보낸 서버 ID (세션 기록에 남아 있으므로 다음 턴부터는 생략)
+knowledge_sent_guilds = set()
+
+# 서버별 메시지 대기열과 이를 처리하는 작업(서버당 하나, 채팅 세션은 한 번에 하나의 요청만 처리 가능)
+# 대기 시간(초) 안에 연달아 들어온 메시지는 한 번의 Gemini 호출로 묶어서 처리
+MESSAGE_BATCH_WINDOW = 0.3
+message_queues = {}
+queue_workers = {}
+
+# 반복되는 짧은 메시지(인사 등)의 응답 캐시: (서버 ID, 닉네임, 메시지) -> (저장 시각, 직렬화된 응답 메시지)
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 600  # 초
+# 문맥이나 시간에 따라 답이 달라지지 않는 인사말만 캐시 (전체 일치, 뒤따르는 문장부호/ㅎㅋ 허용)
+RESPONSE_CACHE_PATTERN = re.compile(r"(안녕(하세요)?|ㅎㅇ|하이|반가워(요)?|hi|hello)[\s!~.ㅎㅋ]*", re.IGNORECASE)
+response_cache = OrderedDict()
 
 # 서버 ID(guild_id)를 키로 사용하여 웹소켓 클라이언트 집합을 관리
 clients_by_guild = defaultdict(set)
 # 웹소켓 객체를 키로 사용하여 서버 ID를 추적 (연결 종료 시 정리용)
 client_to_guild = {}
+# 브로드캐스트용 클라이언트 목록 스냅샷 (연결/해제 시에만 무효화)
+_client_snapshot = {}
 
 # 감정 키워드 매핑
 EMOTION_SPRITE_MAP = {
@@ -94,16 +171,75 @@ EMOTION_SPRITE_MAP = {
     "angry2": "yuuka_angry2.png",
 }
 
+# Gemini 응답에서 JSON 부분을 추출하는 패턴 (```json 코드 블록을 먼저 찾고, 없을 때만 가장 바깥 중괄호 구간 사용)
+GEMINI_JSON_FENCE_PATTERN = re.compile(r"```json\s*(\{.*?\})\s*```", re.DOTALL)
+GEMINI_JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+# 스트리밍 도중 "emotion" 값이 완성되는 즉시 감지하기 위한 패턴
+GEMINI_EMOTION_PATTERN = re.compile(r'"emotion"\s*:\s*"([^"]*)"')
+# 이 길이를 넘는 응답은 별도 스레드에서 파싱
+LARGE_RESPONSE_LENGTH = 64 * 1024
+
 # 웹소켓 관련 함수 (서버 ID 기반으로 변경)
-async def broadcast_to_clients(guild_id: str, message_data: dict):
-    """지정된 서버 ID에 연결된 모든 클라이언트에게 메시지를 전송합니다."""
-    if guild_id in clients_by_guild:
-        clients = clients_by_guild[guild_id]
-        if clients:
-            message_json = json.dumps(message_data)
-            # asyncio.gather를 사용하여 동시에 여러 클라이언트에게 전송
-            await asyncio.gather(*[client.send(message_json) for client in clients])
-            print(f"서버 ID '{guild_id}'의 {len(clients)}개 클라이언트로 데이터 전송: {message_json}")
+@functools.lru_cache(maxsize=512)
+def encode_message(text: str, sprite: str) -> str:
+    """(대사, 스프라이트) 쌍을 웹 클라이언트로 보낼 JSON 문자열로 변환합니다. 같은 쌍은 캐시된 결과를 재사용합니다."""
+    message_data = {"text": text, "sprite": sprite}
+    if orjson is not None:
+        return orjson.dumps(message_data).decode("utf-8")
+    return json.dumps(message_data, ensure_ascii=False)
+
+# 스트리밍 도중 감정만 먼저 알려줄 때 보내는 메시지는 감정별로 시작 시 미리 직렬화
+EARLY_SPRITE_PAYLOADS = {key: encode_message("...", sprite) for key, sprite in EMOTION_SPRITE_MAP.items()}
+
+def broadcast_to_clients(guild_id: str, message_json: str):
+    """
+    지정된 서버 ID에 연결된 모든 클라이언트에게 이미 직렬화된 메시지(encode_message 결과)를 전송합니다.
+    (bytes로 보내면 바이너리 프레임이 되어 웹 클라이언트의 JSON 파싱이 깨지므로 str(텍스트 프레임)로 전송)
+    """
+    clients = get_client_snapshot(guild_id)
+    if not clients:
+        return
+
+    # websockets.broadcast는 프레임을 한 번만 만들어 모든 연결에 바로 기록 (클라이언트별 Task 생성 없음)
+    websockets.broadcast(clients, message_json)
+    print(f"서버 ID '{guild_id}'의 {len(clients)}개 클라이언트로 데이터 전송: {message_json}")
+
+    # 이미 닫힌 연결은 전송 대상에서 정리 (스냅샷을 순회하므로 정리 중 집합이 바뀌어도 안전)
+    for client in clients:
+        if client.state is State.CLOSED:
+            unregister_client(client)
+
+def get_client_snapshot(guild_id: str) -> tuple:
+    """서버의 클라이언트 목록을 튜플로 반환합니다. 연결 상태가 바뀌기 전까지는 같은 튜플을 재사용합니다."""
+    snapshot = _client_snapshot.get(guild_id)
+    if snapshot is None:
+        clients = clients_by_guild.get(guild_id)
+        if not clients:
+            return ()
+        snapshot = _client_snapshot[guild_id] = tuple(clients)
+    return snapshot
+
+def register_client(websocket, guild_id: str):
+    """클라이언트를 서버 ID의 관리 목록에 추가합니다."""
+    clients_by_guild[guild_id].add(websocket)
+    client_to_guild[websocket] = guild_id
+    _client_snapshot.pop(guild_id, None)
+
+def unregister_client(websocket):
+    """클라이언트를 관리 목록에서 제거합니다. 이미 제거된 경우 아무것도 하지 않습니다."""
+    guild_id = client_to_guild.pop(websocket, None)
+    if guild_id is None:
+        return False
+
+    _client_snapshot.pop(guild_id, None)
+    clients = clients_by_guild.get(guild_id)
+    if clients is not None:
+        clients.discard(websocket)
+        # 해당 서버에 더 이상 연결된 클라이언트가 없으면 키 삭제
+        if not clients:
+            del clients_by_guild[guild_id]
+    print(f"서버 ID '{guild_id}'에서 클라이언트 연결 해제됨: {websocket.remote_address}")
+    return True
 
 async def websocket_handler(websocket):
     """웹 클라이언트 연결을 처리하고, 서버 ID에 따라 등록 및 관리합니다."""
@@ -111,13 +247,12 @@ async def websocket_handler(websocket):
     try:
         # 클라이언트로부터 첫 메시지(등록 정보)를 기다림
         message = await websocket.recv()
-        data = json.loads(message)
+        data = json_loads(message)
 
         # 등록 메시지인지, guild_id가 포함되어 있는지 확인
         if data.get("type") == "register" and "guild_id" in data:
             guild_id = data["guild_id"]
-            clients_by_guild[guild_id].add(websocket)
-            client_to_guild[websocket] = guild_id
+            register_client(websocket, guild_id)
             print(f"클라이언트 {websocket.remote_address}가 서버 ID '{guild_id}'에 등록되었습니다.")
             
             # 연결이 끊길 때까지 대기
@@ -130,54 +265,198 @@ async def websocket_handler(websocket):
     except (websockets.exceptions.ConnectionClosedError, json.JSONDecodeError, KeyError) as e:
         print(f"클라이언트 등록 중 오류 또는 연결 종료: {e}")
     finally:
-        # 클라이언트 연결 종료 시, 관리 목록에서 제거
-        if websocket in client_to_guild:
-            guild_id = client_to_guild[websocket]
-            clients_by_guild[guild_id].remove(websocket)
-            # 해당 서버에 더 이상 연결된 클라이언트가 없으면 키 삭제
-            if not clients_by_guild[guild_id]:
-                del clients_by_guild[guild_id]
-            del client_to_guild[websocket]
-            print(f"서버 ID '{guild_id}'에서 클라이언트 연결 해제됨: {websocket.remote_address}")
-        else:
-            print(f"등록되지 않은 클라이언트 연결 해제됨: {websocket.remote_address}")
+        # 클라이언트 연결 종료 시, 관리 목록에서 제거 (브로드캐스트 중 이미 정리되었을 수 있음)
+        if not unregister_client(websocket):
+            print(f"등록되지 않았거나 이미 정리된 클라이언트 연결 해제됨: {websocket.remote_address}")
 
 # Knowledge Base 로딩
+def load_image(source, max_side: int = IMAGE_MAX_SIDE) -> Image.Image:
+    """
+    이미지를 미리 디코딩하고 최대 크기로 줄인 RGB 사본을 반환하는 함수
+    (원본 파일 핸들은 바로 닫히므로 캐시에 보관해도 파일이나 원본 해상도 버퍼를 붙잡지 않음)
+    """
+    with Image.open(source) as img:
+        img.load()
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            # 투명 영역이 검게 변하지 않도록 알파 채널을 마스크로 흰 배경 위에 합성
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, "white")
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        else:
+            img = img.convert("RGB")
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    return img
+
+async def read_attachment_image(attachment) -> Image.Image:
+    """첨부 이미지를 내려받은 뒤, 디코딩과 축소는 이벤트 루프를 막지 않도록 별도 스레드에서 처리합니다."""
+    image_bytes = await attachment.read()
+    return await asyncio.to_thread(load_image, io.BytesIO(image_bytes))
+
+def build_knowledge_composite(images: list):
+    """
+    (파일명, 이미지) 목록을 격자 형태의 합성 이미지 한 장으로 만들고, (합성 이미지, 칸별 파일명 색인)을 반환하는 함수
+    """
+    if len(images) == 1:
+        file_name, img = images[0]
+        return img, f"- 1행 1열: {file_name}"
+
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    composite = Image.new("RGB", (columns * KNOWLEDGE_TILE_SIDE, rows * KNOWLEDGE_TILE_SIDE), "white")
+    index_lines = []
+    for i, (file_name, img) in enumerate(images):
+        row, column = divmod(i, columns)
+        tile = img.copy()
+        tile.thumbnail((KNOWLEDGE_TILE_SIDE, KNOWLEDGE_TILE_SIDE), Image.LANCZOS)
+        # 각 칸의 가운데에 배치
+        composite.paste(tile, (
+            column * KNOWLEDGE_TILE_SIDE + (KNOWLEDGE_TILE_SIDE - tile.width) // 2,
+            row * KNOWLEDGE_TILE_SIDE + (KNOWLEDGE_TILE_SIDE - tile.height) // 2,
+        ))
+        index_lines.append(f"- {row + 1}행 {column + 1}열: {file_name}")
+    composite.thumbnail((KNOWLEDGE_COMPOSITE_MAX_SIDE, KNOWLEDGE_COMPOSITE_MAX_SIDE), Image.LANCZOS)
+    return composite, "\n".join(index_lines)
+
 def load_knowledge_base():
-    global knowledge_cache
+    global knowledge_cache, KNOWLEDGE_TEXT, KNOWLEDGE_COMPOSITE, KNOWLEDGE_GENERATION
+    KNOWLEDGE_GENERATION += 1
     knowledge_cache = {}
-    
-    file_patterns = [
-        f"{KNOWLEDGE_BASE_DIR}/*.txt", f"{KNOWLEDGE_BASE_DIR}/*.md",
-        f"{KNOWLEDGE_BASE_DIR}/*.png", f"{KNOWLEDGE_BASE_DIR}/*.jpg",
-        f"{KNOWLEDGE_BASE_DIR}/*.jpeg", f"{KNOWLEDGE_BASE_DIR}/*.webp"
-    ]
-    files_to_load = []
-    for pattern in file_patterns:
-        files_to_load.extend(glob.glob(pattern))
+    KNOWLEDGE_TEXT = ""
+    KNOWLEDGE_COMPOSITE = None
     
     if not os.path.exists(KNOWLEDGE_BASE_DIR):
         print(f"경고: '{KNOWLEDGE_BASE_DIR}' 폴더를 찾을 수 없습니다.")
         return
 
     print(f"'{KNOWLEDGE_BASE_DIR}' 폴더에서 지식 베이스 파일을 로드합니다...")
-    for file_path in files_to_load:
-        file_name = os.path.basename(file_path)
-        try:
-            if file_path.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-                knowledge_cache[file_name] = Image.open(file_path)
-                print(f" - 성공 (이미지): '{file_name}'")
-            else:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    knowledge_cache[file_name] = f.read()
-                    print(f" - 성공 (텍스트): '{file_name}'")
-        except Exception as e:
-            print(f" - 실패: '{file_path}' 파일을 읽는 중 오류 발생: {e}")
+    # 폴더를 한 번만 훑으면서 확장자로 처리 방식을 결정
+    with os.scandir(KNOWLEDGE_BASE_DIR) as it:
+        for entry in it:
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            file_name = entry.name
+            ext = file_name.rsplit('.', 1)[-1].lower()
+            try:
+                if ext in KNOWLEDGE_IMAGE_EXTENSIONS:
+                    knowledge_cache[file_name] = load_image(entry.path)
+                    print(f" - 성공 (이미지): '{file_name}'")
+                elif ext in KNOWLEDGE_TEXT_EXTENSIONS:
+                    with open(entry.path, 'r', encoding='utf-8') as f:
+                        knowledge_cache[file_name] = f.read()
+                        print(f" - 성공 (텍스트): '{file_name}'")
+            except Exception as e:
+                print(f" - 실패: '{entry.path}' 파일을 읽는 중 오류 발생: {e}")
+
+    # 지식은 /지식갱신 때만 바뀌므로 프롬프트용 텍스트와 합성 이미지를 여기서 한 번만 구성
+    if knowledge_cache:
+        parts = ["--- 참고 자료 ---\n"]
+        images = []
+        for file_name, content in knowledge_cache.items():
+            if isinstance(content, str):
+                parts.append(f"\n[파일: {file_name}]\n{content}\n")
+            elif isinstance(content, Image.Image):
+                images.append((file_name, content))
+        # 이미지는 여러 장을 따로 보내지 않고 한 장으로 합친 뒤, 각 칸이 어떤 파일인지 색인을 함께 전달
+        if images:
+            KNOWLEDGE_COMPOSITE, image_index = build_knowledge_composite(images)
+            parts.append(f"\n[이미지 색인] 함께 첨부된 참고 이미지의 각 칸에 해당하는 파일\n{image_index}\n")
+        KNOWLEDGE_TEXT = "".join(parts) + "--- 끝 ---\n\n"
     print("지식 베이스 로딩 완료!")
 
 # Gemini 설정
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-flash', system_instruction=GEM_PROMPT)
+# 프로세스 전체에서 하나의 클라이언트를 재사용하여 HTTP 연결(TLS 세션)을 매 요청마다 새로 맺지 않도록 함
+GEMINI_MODEL = "gemini-2.5-flash"
+gemini_client = genai.Client(api_key=GEMINI_API_KEY)
+gemini_chat_config = types.GenerateContentConfig(system_instruction=GEM_PROMPT)
+
+def start_chat_session():
+    """공유 클라이언트의 비동기 API로 새 채팅 세션을 생성합니다."""
+    return gemini_client.aio.chats.create(model=GEMINI_MODEL, config=gemini_chat_config, history=[])
+
+def get_chat_session(guild_id: int):
+    """
+    서버의 채팅 세션을 반환하는 함수 (없으면 새로 만들고, MAX_CACHED_GUILDS를 넘으면 가장 오래 사용하지 않은 세션을 제거)
+    """
+    session = chat_sessions.get(guild_id)
+    if session is None:
+        session = chat_sessions[guild_id] = start_chat_session()
+        knowledge_sent_guilds.discard(guild_id)
+        while len(chat_sessions) > MAX_CACHED_GUILDS:
+            evicted_guild_id, _ = chat_sessions.popitem(last=False)
+            knowledge_sent_guilds.discard(evicted_guild_id)
+    else:
+        chat_sessions.move_to_end(guild_id)
+    return session
+
+def get_cached_response(key):
+    """
+    캐시된 직렬화 응답 메시지를 반환하는 함수 (없거나 TTL이 지났으면 None)
+    """
+    entry = response_cache.get(key)
+    if entry is None:
+        return None
+    stored_at, message_json = entry
+    if time.monotonic() - stored_at > RESPONSE_CACHE_TTL:
+        del response_cache[key]
+        return None
+    response_cache.move_to_end(key)
+    return message_json
+
+def store_cached_response(key, message_json: str):
+    """
+    응답을 캐시에 저장하는 함수 (RESPONSE_CACHE_SIZE를 넘으면 가장 오래 사용하지 않은 항목부터 제거)
+    """
+    response_cache[key] = (time.monotonic(), message_json)
+    response_cache.move_to_end(key)
+    while len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+
+def clear_cached_responses(guild_id: int = None):
+    """
+    응답 캐시를 비우는 함수 (guild_id를 주면 해당 서버의 항목만 제거)
+    """
+    if guild_id is None:
+        response_cache.clear()
+        return
+    for key in [key for key in response_cache if key[0] == guild_id]:
+        del response_cache[key]
+
+def parse_gemini_response(raw_response: str):
+    """
+    Gemini 응답에서 (대사, 스프라이트 파일명, JSON 파싱 성공 여부)를 추출하는 함수
+    """
+    dialogue_text = ""
+    parsed = False
+    sprite_filename = EMOTION_SPRITE_MAP["neutral"] # 기본값 설정
+
+    try:
+        # 1. 응답에서 JSON 문자열 부분만 정확히 추출
+        #    (코드 블록을 먼저 찾아야 블록 앞에 떨어진 '{'가 있어도 코드 블록이 우선됨)
+        fence_match = GEMINI_JSON_FENCE_PATTERN.search(raw_response)
+        if fence_match:
+            json_str = fence_match.group(1)
+        else:
+            object_match = GEMINI_JSON_OBJECT_PATTERN.search(raw_response)
+            json_str = object_match.group(0) if object_match else ""
+
+        # 2. 추출된 문자열이 있다면 JSON으로 파싱
+        if json_str:
+            gemini_data = json_loads(json_str)
+            dialogue_text = gemini_data.get("text", "...")
+            emotion_key = gemini_data.get("emotion", "neutral")
+            sprite_filename = EMOTION_SPRITE_MAP.get(emotion_key, EMOTION_SPRITE_MAP["neutral"])
+            parsed = True
+        else:
+            # 3. JSON 구조를 찾지 못하면, 원본 응답을 일반 텍스트로 사용
+            print("JSON 구조를 찾지 못했습니다. 일반 텍스트로 처리합니다.")
+            dialogue_text = raw_response.strip()
+
+    except (json.JSONDecodeError, KeyError) as e:
+        # 4. JSON 파싱에 실패하면, 원본 응답을 정리하여 일반 텍스트로 사용
+        print(f"JSON 파싱 실패 ({e}). 응답을 일반 텍스트로 처리합니다.")
+        dialogue_text = raw_response.replace("```json", "").replace("```", "").strip()
+
+    return dialogue_text, sprite_filename, parsed
 
 # Discord 봇 기본 설정
 intents = discord.Intents.default()
@@ -220,26 +499,27 @@ async def set_channel_error(interaction: discord.Interaction, error):
 # ✅ /새대화 명령어
 @bot.tree.command(name="새대화", description="유우카와의 대화를 초기화합니다.")
 async def reset_conversation(interaction: discord.Interaction):
-    current_channel_id = int(os.getenv("CHANNEL_ID", "0"))
-    if interaction.channel.id != current_channel_id:
+    if interaction.channel.id != CHANNEL_ID:
         await interaction.response.send_message(
-            f"이 명령어는 지정된 채널(<#{current_channel_id}>)에서만 사용할 수 있어요.",
+            f"이 명령어는 지정된 채널(<#{CHANNEL_ID}>)에서만 사용할 수 있어요.",
             ephemeral=True
         )
         return
 
     guild_id = interaction.guild.id
-    chat_sessions[guild_id] = model.start_chat(history=[])
+    # 다음 메시지에서 get_chat_session이 새 세션을 생성
+    chat_sessions.pop(guild_id, None)
+    knowledge_sent_guilds.discard(guild_id)
+    clear_cached_responses(guild_id)
     print(f"관리자({interaction.user})가 대화를 초기화했습니다. (서버: {interaction.guild.name})")
     await interaction.response.send_message(f"{interaction.user.mention} 알겠습니다! 새로운 대화를 시작할게요 ✨")
 
 # ✅ /지식갱신 명령어
 @bot.tree.command(name="지식갱신", description="Knowledge Base 폴더의 파일들을 다시 불러옵니다.")
 async def reload_knowledge(interaction: discord.Interaction):
-    current_channel_id = int(os.getenv("CHANNEL_ID", "0"))
-    if interaction.channel.id != current_channel_id:
+    if interaction.channel.id != CHANNEL_ID:
         await interaction.response.send_message(
-            f"이 명령어는 지정된 채널(<#{current_channel_id}>)에서만 사용할 수 있어요.",
+            f"이 명령어는 지정된 채널(<#{CHANNEL_ID}>)에서만 사용할 수 있어요.",
             ephemeral=True
         )
         return
@@ -247,6 +527,9 @@ async def reload_knowledge(interaction: discord.Interaction):
     await interaction.response.defer()
     print(f"{interaction.user}님이 지식 베이스를 새로고침했습니다. (서버: {interaction.guild.name})")
     load_knowledge_base()
+    # 갱신된 지식은 각 서버의 다음 메시지에서 다시 전달
+    knowledge_sent_guilds.clear()
+    clear_cached_responses()
     await interaction.followup.send(f"지식 파일들을 새로고침했어요! ({len(knowledge_cache)}개 파일 로드됨)")
 
 # ✅ /주소 명령어
@@ -273,8 +556,8 @@ async def on_message(message):
     if message.author == bot.user or not message.guild:
         return
 
-    current_channel_id = int(os.getenv("CHANNEL_ID", "0"))
-    if message.channel.id != current_channel_id:
+    # CHANNEL_ID는 /채널지정 실행 시에만 갱신되므로 매 메시지마다 환경 변수를 다시 읽지 않음
+    if message.channel.id != CHANNEL_ID:
         return
     
     guild_id = message.guild.id
@@ -284,83 +567,144 @@ async def on_message(message):
         print(f"서버 ID '{guild_id_str}'에 연결된 웹 클라이언트 없음 — 메시지 처리 중단.")
         return
 
-    async with processing_lock:
-        if guild_id not in chat_sessions:
-            chat_sessions[guild_id] = model.start_chat(history=[])
+    if not message.content.strip() and not message.attachments:
+        return
 
-        current_session = chat_sessions[guild_id]
-        user_nickname = message.author.display_name
-        user_message = message.content.strip()
-        
-        if not user_message and not message.attachments:
-            return
-        
-        prompt_parts = []
-        knowledge_text_context = ""
-        if knowledge_cache:
-            knowledge_text_context += "--- 참고 자료 ---\n"
-            for file_name, content in knowledge_cache.items():
-                if isinstance(content, str):
-                    knowledge_text_context += f"\n[파일: {file_name}]\n{content}\n"
-                elif isinstance(content, Image.Image):
-                    prompt_parts.append(content)
-            knowledge_text_context += "--- 끝 ---\n\n"
-
-        full_text_prompt = f"{knowledge_text_context}내 이름은 '{user_nickname}'이야.\n\n{user_message}"
-        prompt_parts.insert(0, full_text_prompt)
-
-        for attachment in message.attachments:
-            if attachment.content_type and attachment.content_type.startswith('image/'):
-                try:
-                    image_bytes = await attachment.read()
-                    img = Image.open(io.BytesIO(image_bytes))
-                    prompt_parts.append(img)
-                    print(f"사용자 첨부 이미지 추가: {attachment.filename}")
-                except Exception as e:
-                    print(f"첨부 이미지 처리 중 오류 발생: {e}")
-
-        async with message.channel.typing():
-            try:
-                response = await asyncio.to_thread(current_session.send_message, prompt_parts)
-                raw_response = response.text
-                print(f"Gemini 원본 응답: {raw_response}")
-
-                dialogue_text = ""
-                sprite_filename = EMOTION_SPRITE_MAP["neutral"] # 기본값 설정
-
-                try:
-                    # 1. 응답에서 JSON 문자열 부분만 정확히 추출
-                    json_str = ""
-                    if "```json" in raw_response:
-                        json_str = raw_response.split("```json")[1].split("```")[0].strip()
-                    else:
-                        json_start = raw_response.find('{')
-                        json_end = raw_response.rfind('}') + 1
-                        if json_start != -1 and json_end > json_start:
-                            json_str = raw_response[json_start:json_end]
-
-                    # 2. 추출된 문자열이 있다면 JSON으로 파싱
-                    if json_str:
-                        gemini_data = json.loads(json_str)
-                        dialogue_text = gemini_data.get("text", "...")
-                        emotion_key = gemini_data.get("emotion", "neutral")
-                        sprite_filename = EMOTION_SPRITE_MAP.get(emotion_key, EMOTION_SPRITE_MAP["neutral"])
-                    else:
-                        # 3. JSON 구조를 찾지 못하면, 원본 응답을 일반 텍스트로 사용
-                        print("JSON 구조를 찾지 못했습니다. 일반 텍스트로 처리합니다.")
-                        dialogue_text = raw_response.strip()
-
-                except (json.JSONDecodeError, KeyError) as e:
-                    # 4. JSON 파싱에 실패하면, 원본 응답을 정리하여 일반 텍스트로 사용
-                    print(f"JSON 파싱 실패 ({e}). 응답을 일반 텍스트로 처리합니다.")
-                    dialogue_text = raw_response.replace("```json", "").replace("```", "").strip()
-                
-                # 최종적으로 정리된 데이터를 클라이언트로 전송
-                await broadcast_to_clients(guild_id_str, {"text": dialogue_text, "sprite": sprite_filename})
+    # 서버별 대기열에 넣고, 처리 작업이 없으면 새로 시작 (서버당 작업은 하나이므로 Gemini 호출이 직렬화됨)
+    queue = message_queues.get(guild_id)
+    if queue is None:
+        queue = message_queues[guild_id] = asyncio.Queue()
+    queue.put_nowait(message)
+    if guild_id not in queue_workers:
+        queue_workers[guild_id] = asyncio.create_task(process_message_queue(guild_id))
 
+async def process_message_queue(guild_id: int):
+    """
+    서버의 메시지 대기열을 처리하는 함수
+    (MESSAGE_BATCH_WINDOW 동안 쌓인 메시지를 모아 한 번의 Gemini 호출로 응답하고, 대기열이 비면 종료)
+    """
+    queue = message_queues[guild_id]
+    try:
+        while not queue.empty():
+            await asyncio.sleep(MESSAGE_BATCH_WINDOW)
+            messages = []
+            while not queue.empty():
+                messages.append(queue.get_nowait())
+            try:
+                await respond_to_messages(guild_id, messages)
             except Exception as e:
-                print(f"Gemini API 호출 중 심각한 오류 발생: {e}")
-                await message.channel.send(f"으앗, 선생님 죄송해요. 생각에 잠시 오류가 생긴 것 같아요: `{e}`")
+                print(f"메시지 처리 중 오류 발생 (서버 ID: {guild_id}): {e}")
+    finally:
+        del queue_workers[guild_id]
+        if queue.empty():
+            del message_queues[guild_id]
+
+async def respond_to_messages(guild_id: int, messages: list):
+    """같은 서버에서 연달아 들어온 메시지들을 하나의 프롬프트로 묶어 Gemini에 보내고, 결과를 웹 클라이언트로 전송합니다."""
+    guild_id_str = str(guild_id)
+    last_message = messages[-1]
+    attachments = [attachment for message in messages for attachment in message.attachments]
+
+    cache_key = None
+    if len(messages) == 1:
+        user_nickname = last_message.author.display_name
+        user_message = last_message.content.strip()
+        user_text_prompt = f"내 이름은 '{user_nickname}'이야.\n\n{user_message}"
+
+        # 첨부 파일 없는 인사말은 같은 사용자의 최근 응답을 재사용하여 Gemini 호출을 생략
+        # (세션을 만들거나 LRU 순서를 바꾸지 않도록 get_chat_session보다 먼저 확인)
+        if not attachments and RESPONSE_CACHE_PATTERN.fullmatch(user_message):
+            cache_key = (guild_id, user_nickname, user_message)
+            cached_json = get_cached_response(cache_key)
+            if cached_json is not None:
+                print(f"캐시된 응답 사용: {user_message}")
+                broadcast_to_clients(guild_id_str, cached_json)
+                return
+    else:
+        # 여러 메시지는 [닉네임] 태그를 붙여 한 번에 전달
+        lines = "\n".join(f"[{message.author.display_name}] {message.content.strip()}" for message in messages)
+        user_text_prompt = f"여러 사람이 연달아 말했어. 각 줄의 [이름]은 말한 사람이야.\n\n{lines}"
+        print(f"서버 ID '{guild_id_str}'의 메시지 {len(messages)}개를 한 번에 처리합니다.")
+
+    current_session = get_chat_session(guild_id)
+
+    # 지식 베이스는 세션의 첫 턴에만 보내고, 이후에는 세션 기록에 있는 내용을 그대로 활용
+    include_knowledge = guild_id not in knowledge_sent_guilds
+    knowledge_generation = KNOWLEDGE_GENERATION
+    if include_knowledge:
+        prompt_parts = [f"{KNOWLEDGE_TEXT}{user_text_prompt}"]
+        if KNOWLEDGE_COMPOSITE is not None:
+            prompt_parts.append(KNOWLEDGE_COMPOSITE)
+    else:
+        prompt_parts = [user_text_prompt]
+
+    # 첨부 이미지는 순차적으로 받지 않고 동시에 다운로드/디코딩
+    image_attachments = [
+        attachment for attachment in attachments
+        if attachment.content_type and attachment.content_type.startswith('image/')
+    ]
+    images = await asyncio.gather(*(read_attachment_image(attachment) for attachment in image_attachments), return_exceptions=True)
+    for attachment, img in zip(image_attachments, images):
+        if isinstance(img, Exception):
+            print(f"첨부 이미지 처리 중 오류 발생: {img}")
+        elif isinstance(img, BaseException):
+            raise img
+        else:
+            prompt_parts.append(img)
+            print(f"사용자 첨부 이미지 추가: {attachment.filename}")
+
+    async with last_message.channel.typing():
+        try:
+            # 차단되거나 비어 있는 응답은 SDK가 세션 기록(curated history)에서 제외하므로, 기록이 실제로 늘었는지 확인하기 위해 길이를 저장
+            history_length = len(current_session.get_history(curated=True))
+
+            # 응답을 스트리밍으로 받으면서, 감정 값이 나오는 즉시 스프라이트부터 먼저 반영
+            raw_response = ""
+            early_sprite_sent = False
+            async for chunk in await current_session.send_message_stream(prompt_parts):
+                raw_response += chunk.text or ""
+                if not early_sprite_sent:
+                    emotion_match = GEMINI_EMOTION_PATTERN.search(raw_response)
+                    if emotion_match:
+                        early_sprite_sent = True
+                        broadcast_to_clients(
+                            guild_id_str,
+                            EARLY_SPRITE_PAYLOADS.get(emotion_match.group(1), EARLY_SPRITE_PAYLOADS["neutral"])
+                        )
+            print(f"Gemini 원본 응답: {raw_response}")
+
+            # 이번 턴이 세션 기록에 남았을 때만 지식 전달 완료로 표시
+            # (도중에 /새대화로 세션이 바뀌었거나 /지식갱신으로 지식이 바뀌었으면 제외)
+            if (
+                include_knowledge
+                and len(current_session.get_history(curated=True)) > history_length
+                and chat_sessions.get(guild_id) is current_session
+                and KNOWLEDGE_GENERATION == knowledge_generation
+            ):
+                knowledge_sent_guilds.add(guild_id)
+
+            if not raw_response.strip():
+                print(f"Gemini가 빈 응답을 반환했습니다 (서버 ID: {guild_id_str}). 클라이언트로 전송하지 않습니다.")
+                return
+
+            # 응답이 매우 큰 경우에만 이벤트 루프를 막지 않도록 별도 스레드에서 파싱
+            if len(raw_response) > LARGE_RESPONSE_LENGTH:
+                dialogue_text, sprite_filename, parsed = await asyncio.to_thread(parse_gemini_response, raw_response)
+            else:
+                dialogue_text, sprite_filename, parsed = parse_gemini_response(raw_response)
+
+            message_json = encode_message(dialogue_text, sprite_filename)
+
+            # 정상적으로 파싱된 응답만 캐시
+            if parsed and cache_key is not None:
+                store_cached_response(cache_key, message_json)
+            
+            # 최종적으로 정리된 데이터를 클라이언트로 전송
+            broadcast_to_clients(guild_id_str, message_json)
+
+        except Exception as e:
+            print(f"Gemini API 호출 중 심각한 오류 발생: {e}")
+            await last_message.channel.send(f"으앗, 선생님 죄송해요. 생각에 잠시 오류가 생긴 것 같아요: `{e}`")
 
 # 실행
 async def main():
@@ -372,7 +716,10 @@ async def main():
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
 
         print("\n봇을 종료합니다.")